@@ -1,11 +1,29 @@
-import sqlite3
 import os
 import openai
-import datetime
 import time
+import random
+import asyncio
+import hashlib
+import json
+import queue
+import threading
+import contextlib
+import weakref
 
 import logging
 
+try:
+    # pysqlite3 bundles a current SQLite build, which may be newer than the
+    # one the interpreter was compiled against
+    import pysqlite3 as sqlite3
+except ImportError:
+    import sqlite3
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
 from dotenv import load_dotenv
@@ -15,19 +33,324 @@ load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 LLM_RETRIES = int(os.getenv("LLM_RETRIES", 3))  # type: ignore
 LLM_RETRY_DELAY_SECONDS = int(os.getenv("LLM_RETRY_DELAY_SECONDS", 2))  # type: ignore
+LLM_RETRY_MAX_DELAY_SECONDS = int(os.getenv("LLM_RETRY_MAX_DELAY_SECONDS", 30))  # type: ignore
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 8))  # type: ignore
+LLM_READ_POOL_SIZE = int(os.getenv("LLM_READ_POOL_SIZE", 4))  # type: ignore
+LLM_WRITE_BATCH_SIZE = int(os.getenv("LLM_WRITE_BATCH_SIZE", 100))  # type: ignore
+LLM_WRITE_INTERVAL_MS = int(os.getenv("LLM_WRITE_INTERVAL_MS", 50))  # type: ignore
+LLM_SEMANTIC_CACHE_MODEL = os.getenv("LLM_SEMANTIC_CACHE_MODEL", "all-MiniLM-L6-v2")
+LLM_SEMANTIC_CACHE_THRESHOLD = float(os.getenv("LLM_SEMANTIC_CACHE_THRESHOLD", 0.92))  # type: ignore
+
+# INSERT ... RETURNING needs SQLite 3.35 or newer, which older stdlib
+# builds do not have
+SQLITE_SUPPORTS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Bump whenever the expected table schema changes
+SCHEMA_VERSION = 1
+
+
+def _json_dumps(payload):
+    # orjson is an optional speedup; both produce compact JSON
+    if orjson is not None:
+        return orjson.dumps(payload).decode()
+    return json.dumps(payload, separators=(",", ":"))
+
+
+def _json_loads(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+class _ResultWriter:
+    # Writes prompt and response rows from a background thread, committing
+    # everything that arrives within a short window in one transaction. It
+    # holds no reference to its LLMManager, so an unclosed manager can still
+    # be garbage collected.
+
+    def __init__(self, connection, write_lock, batch_size, interval_seconds):
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.write_lock = write_lock
+        self.batch_size = batch_size
+        self.interval_seconds = interval_seconds
+        self.queue = queue.Queue()
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, rows):
+        if self.closed:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        if rows:
+            self.queue.put(rows)
+
+    def flush(self):
+        # Block until every queued result has been written
+        if not self.thread.is_alive():
+            if self.queue.unfinished_tasks:
+                raise sqlite3.ProgrammingError(
+                    "Result writer is not running; queued results were not stored."
+                )
+        else:
+            self.queue.join()
+        self.raise_error()
+
+    def raise_error(self):
+        # Re-raise the last failed write once, so callers learn rows were lost
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def stop(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        if threading.current_thread() is self.thread:
+            # The garbage collector ran the manager's finalizer on the writer
+            # thread itself; _run closes the connection once it reaches the
+            # sentinel
+            return
+        try:
+            self.thread.join()
+        finally:
+            self.connection.close()
+
+    def _run(self):
+        try:
+            self._drain()
+        finally:
+            if self.closed:
+                self.connection.close()
+
+    def _drain(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+
+            rows = list(item)
+            received = 1
+            stop = False
+            deadline = time.monotonic() + self.interval_seconds
+            while len(rows) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                received += 1
+                if item is None:
+                    stop = True
+                    break
+                rows.extend(item)
+
+            try:
+                self.store(rows)
+            except Exception as e:
+                logger.exception(f"Failed to store {len(rows)} results")
+                self.error = e
+            finally:
+                for _ in range(received):
+                    self.queue.task_done()
+
+            if stop:
+                return
+
+    def store(self, rows):
+        # rows is a list of (prompt, system_message, model, stable_context, result)
+        # tuples.
+        # Every prompt and response in the batch is written in one transaction.
+        if not rows:
+            return
+
+        # The connection commits on success and rolls back on any error
+        with self.write_lock, self.connection:
+            self.cursor.execute("BEGIN IMMEDIATE")
+            if len(rows) == 1 and SQLITE_SUPPORTS_RETURNING:
+                self.cursor.execute(
+                    """
+                    INSERT INTO prompts (prompt, system_message, model, stable_context)
+                    VALUES (?, ?, ?, ?) RETURNING id
+                """,
+                    rows[0][:4],
+                )
+                first_prompt_id = self.cursor.fetchone()[0]
+            else:
+                self.cursor.executemany(
+                    """
+                    INSERT INTO prompts (prompt, system_message, model, stable_context)
+                    VALUES (?, ?, ?, ?)
+                """,
+                    [row[:4] for row in rows],
+                )
+                # The write lock is held for the whole transaction, so the
+                # AUTOINCREMENT ids assigned to the batch are consecutive and
+                # end at last_insert_rowid()
+                self.cursor.execute("SELECT last_insert_rowid()")
+                last_prompt_id = self.cursor.fetchone()[0]
+                first_prompt_id = last_prompt_id - len(rows) + 1
+            self.cursor.executemany(
+                """
+                INSERT INTO responses (
+                    prompt_id, response, error, status, refusal, finish_reason,
+                    timestamp, prompt_tokens, response_tokens, cached_tokens
+                ) VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, ?, ?, ?)
+            """,
+                [
+                    (
+                        first_prompt_id + offset,
+                        result["response_json_text"],
+                        result["error"],
+                        result["status"],
+                        result["refusal"],
+                        result["finish_reason"],
+                        result["prompt_tokens"],
+                        result["response_tokens"],
+                        result["cached_tokens"],
+                    )
+                    for offset, (*_, result) in enumerate(rows)
+                ],
+            )
+
+
+def _close_resources(result_writer, read_pool, client):
+    # Runs from LLMManager.close(), or when an unclosed manager is garbage
+    # collected or the interpreter exits
+    try:
+        result_writer.stop()
+    finally:
+        try:
+            if read_pool is not None:
+                while not read_pool.empty():
+                    read_pool.get_nowait().close()
+        finally:
+            client.close()
 
 
 class LLMManager:
-    def __init__(self, db_filename, api_key):
+    def __init__(
+        self,
+        db_filename,
+        api_key,
+        semantic_cache=False,
+        semantic_cache_threshold=LLM_SEMANTIC_CACHE_THRESHOLD,
+        store_full_response=False,
+        warmup=True,
+    ):
         self.db_filename = db_filename
         self.api_key = api_key
         openai.api_key = self.api_key
         self.retries = LLM_RETRIES
         self.retry_delay_seconds = LLM_RETRY_DELAY_SECONDS
-        self.connection = sqlite3.connect(self.db_filename)
+        self.retry_max_delay_seconds = LLM_RETRY_MAX_DELAY_SECONDS
+        self.max_concurrency = LLM_MAX_CONCURRENCY
+        # By default only the fields callers use are stored, instead of the
+        # full serialized API response
+        self.store_full_response = store_full_response
+        # The semantic cache needs the optional "semantic" extras, which are
+        # only imported the first time the cache is consulted
+        self.semantic_cache = semantic_cache
+        self.semantic_cache_threshold = semantic_cache_threshold
+        self.embedder = None
+        self.semantic_indexes = {}
+        # SDK retries are disabled because the retry loop below handles them
+        self.client = openai.OpenAI(api_key=self.api_key, max_retries=0)
+        # The async client's connection pool belongs to the event loop that
+        # first uses it, so the async methods must all run on one loop. Call
+        # aclose() from that loop when done.
+        self.async_client = openai.AsyncOpenAI(api_key=self.api_key, max_retries=0)
+        # Open the clients' connections in the background so the first real
+        # request does not pay for DNS and the TLS handshake
+        self._warmup_task = None
+        if warmup:
+            threading.Thread(target=self.warmup, daemon=True).start()
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                loop = None
+            if loop is not None:
+                self._warmup_task = loop.create_task(self.awarmup())
+        # One writer connection guarded by a lock, plus a pool of read-only
+        # connections for cache lookups. WAL mode lets readers run alongside
+        # the writer.
+        self._write_lock = threading.Lock()
+        self._semantic_lock = threading.Lock()
+        self.connection = self._connect()
         self.cursor = self.connection.cursor()
         self.create_tables()
         self.validate_tables()
+        self._read_pool = None
+        # Each connection to an in-memory database opens a separate database,
+        # so those fall back to reading through the writer connection
+        if self.db_filename != ":memory:":
+            self._read_pool = queue.Queue()
+            for _ in range(LLM_READ_POOL_SIZE):
+                connection = self._connect()
+                connection.execute("PRAGMA query_only=1")
+                self._read_pool.put(connection)
+        # Prompt and response rows are written by a background thread, which
+        # commits everything that arrives within a short window together
+        self._result_writer = _ResultWriter(
+            self.connection,
+            self._write_lock,
+            LLM_WRITE_BATCH_SIZE,
+            LLM_WRITE_INTERVAL_MS / 1000,
+        )
+        # Make sure queued rows reach the database if close() is never called
+        self._finalizer = weakref.finalize(
+            self, _close_resources, self._result_writer, self._read_pool, self.client
+        )
+
+    def warmup(self):
+        try:
+            self.client.models.list(timeout=2)
+        except Exception as e:
+            logger.debug(f"Client warmup failed: {e}")
+
+    async def awarmup(self):
+        # Called automatically when the manager is created inside a running
+        # event loop; otherwise await it before the first async request
+        try:
+            await self.async_client.models.list(timeout=2)
+        except Exception as e:
+            logger.debug(f"Async client warmup failed: {e}")
+
+    def _connect(self):
+        connection = sqlite3.connect(
+            self.db_filename,
+            isolation_level=None,
+            check_same_thread=False,
+            timeout=5.0,
+        )
+        self.configure_connection(connection)
+        return connection
+
+    @contextlib.contextmanager
+    def _read_connection(self):
+        if self._read_pool is None:
+            with self._write_lock:
+                yield self.connection
+            return
+
+        connection = self._read_pool.get()
+        try:
+            yield connection
+        finally:
+            self._read_pool.put(connection)
+
+    def configure_connection(self, connection):
+        # Pragmas are per-connection, so they are re-applied on every open
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA temp_store=MEMORY")
+        connection.execute("PRAGMA cache_size=-64000")
+        connection.execute("PRAGMA mmap_size=268435456")
 
     def create_tables(self):
         # Create prompts table
@@ -37,10 +360,16 @@ class LLMManager:
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 prompt TEXT,
                 system_message TEXT,
-                model TEXT
+                model TEXT,
+                stable_context TEXT
             )
         """
         )
+        self.cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_prompts_model ON prompts(model)
+        """
+        )
 
         # Create responses table
         self.cursor.execute(
@@ -53,162 +382,680 @@ class LLMManager:
                 status TEXT,
                 refusal TEXT,
                 finish_reason TEXT,
-                timestamp DATETIME,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
                 prompt_tokens INTEGER,
                 response_tokens INTEGER,
+                cached_tokens INTEGER,
                 FOREIGN KEY(prompt_id) REFERENCES prompts(id)
             )
         """
         )
 
+        # Create exact-match response cache table. Rows are stored directly in
+        # the hash primary key B-tree, with no separate rowid table.
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS prompt_cache (
+                hash BLOB PRIMARY KEY,
+                content TEXT,
+                response_json TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            ) WITHOUT ROWID
+        """
+        )
+
+        # Create semantic response cache table
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS semantic_cache (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                model TEXT,
+                system_message TEXT,
+                embedding BLOB,
+                content TEXT,
+                response_json TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """
+        )
+
         self.connection.commit()
 
     def validate_tables(self):
+        # A matching user_version means this schema was already validated
+        self.cursor.execute("PRAGMA user_version")
+        if self.cursor.fetchone()[0] == SCHEMA_VERSION:
+            return
+
+        # Bring databases created before a column was added up to date
+        self._add_missing_columns("prompts", {"stable_context": "TEXT"})
+        self._add_missing_columns("responses", {"cached_tokens": "INTEGER"})
+
         # Validate prompts table columns
-        self.cursor.execute("PRAGMA table_info(prompts)")
-        prompts_columns = self.cursor.fetchall()
-        expected_prompts_columns = [
-            ("id", "INTEGER"),
-            ("prompt", "TEXT"),
-            ("system_message", "TEXT"),
-            ("model", "TEXT"),
-        ]
-        for expected_column in expected_prompts_columns:
-            found = False
-            for column in prompts_columns:
-                if (
-                    column[1] == expected_column[0]
-                    and column[2].upper() == expected_column[1]
-                ):
-                    found = True
-                    break
-            if not found:
-                raise Exception(
-                    f"Prompts table schema does not match expected schema. Missing column: {expected_column[0]} {expected_column[1]}"
-                )
+        self._validate_columns(
+            "prompts",
+            "Prompts",
+            {
+                "id": "INTEGER",
+                "prompt": "TEXT",
+                "system_message": "TEXT",
+                "model": "TEXT",
+                "stable_context": "TEXT",
+            },
+        )
 
         # Validate responses table columns
-        self.cursor.execute("PRAGMA table_info(responses)")
-        responses_columns = self.cursor.fetchall()
-        expected_responses_columns = [
-            ("id", "INTEGER"),
-            ("prompt_id", "INTEGER"),
-            ("response", "TEXT"),
-            ("error", "TEXT"),
-            ("status", "TEXT"),
-            ("refusal", "TEXT"),
-            ("finish_reason", "TEXT"),
-            ("timestamp", "DATETIME"),
-            ("prompt_tokens", "INTEGER"),
-            ("response_tokens", "INTEGER"),
-        ]
-        for expected_column in expected_responses_columns:
-            found = False
-            for column in responses_columns:
-                if (
-                    column[1] == expected_column[0]
-                    and column[2].upper() == expected_column[1]
-                ):
-                    found = True
-                    break
-            if not found:
-                raise Exception(
-                    f"Responses table schema does not match expected schema. Missing column: {expected_column[0]} {expected_column[1]}"
+        self._validate_columns(
+            "responses",
+            "Responses",
+            {
+                "id": "INTEGER",
+                "prompt_id": "INTEGER",
+                "response": "TEXT",
+                "error": "TEXT",
+                "status": "TEXT",
+                "refusal": "TEXT",
+                "finish_reason": "TEXT",
+                "timestamp": "DATETIME",
+                "prompt_tokens": "INTEGER",
+                "response_tokens": "INTEGER",
+                "cached_tokens": "INTEGER",
+            },
+        )
+
+        self.cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _add_missing_columns(self, table, columns):
+        self.cursor.execute(f"PRAGMA table_info({table})")
+        existing_columns = {column[1] for column in self.cursor.fetchall()}
+        for name, column_type in columns.items():
+            if name not in existing_columns:
+                self.cursor.execute(
+                    f"ALTER TABLE {table} ADD COLUMN {name} {column_type}"
                 )
 
+    def _validate_columns(self, table, label, expected_columns):
+        self.cursor.execute(f"PRAGMA table_info({table})")
+        columns = {column[1]: column[2].upper() for column in self.cursor.fetchall()}
+        missing = expected_columns.items() - columns.items()
+        if missing:
+            missing_columns = ", ".join(
+                f"{name} {column_type}"
+                for name, column_type in expected_columns.items()
+                if (name, column_type) in missing
+            )
+            raise Exception(
+                f"{label} table schema does not match expected schema. Missing column: {missing_columns}"
+            )
+
     def generate_response(
         self,
         prompt,
         model="gpt-4o",
         system_message="You are a helpful assistant.",
         store=True,
+        temperature=None,
+        use_cache=True,
+        stable_context=None,
+    ):
+        cache_key, embedding, result = self._lookup_cache(
+            prompt, model, system_message, stable_context, temperature, use_cache
+        )
+
+        if result is None:
+            result = self._request_completion(
+                prompt,
+                model,
+                system_message,
+                stable_context=stable_context,
+                temperature=temperature,
+            )
+            self._update_cache(cache_key, embedding, model, system_message, result)
+
+        if store:
+            self._enqueue_results(
+                [(prompt, system_message, model, stable_context, result)]
+            )
+
+        return self._public_result(result)
+
+    def generate_responses(
+        self,
+        prompts,
+        model="gpt-4o",
+        system_message="You are a helpful assistant.",
+        store=True,
+        stable_context=None,
+        temperature=None,
+        use_cache=True,
+    ):
+        rows = []
+        for prompt in prompts:
+            cache_key, embedding, result = self._lookup_cache(
+                prompt, model, system_message, stable_context, temperature, use_cache
+            )
+            if result is None:
+                result = self._request_completion(
+                    prompt,
+                    model,
+                    system_message,
+                    stable_context=stable_context,
+                    temperature=temperature,
+                )
+                self._update_cache(cache_key, embedding, model, system_message, result)
+            rows.append((prompt, system_message, model, stable_context, result))
+
+        if store:
+            self._enqueue_results(rows)
+
+        return [self._public_result(row[4]) for row in rows]
+
+    def generate_response_stream(
+        self,
+        prompt,
+        model="gpt-4o",
+        system_message="You are a helpful assistant.",
+        store=True,
+        temperature=None,
+        use_cache=True,
+        stable_context=None,
     ):
-        prompt_id = None
-        error_message = None
-        response_json_text = None
-        status = "failure"
-        refusal = None
-        finish_reason = None
-        content = None
-        prompt_tokens = None
-        response_tokens = None
+        # Yields content deltas as they arrive and stores the assembled
+        # response once the stream ends
+        cache_key, embedding, result = self._lookup_cache(
+            prompt, model, system_message, stable_context, temperature, use_cache
+        )
+        if result is not None:
+            if store:
+                self._enqueue_results(
+                    [(prompt, system_message, model, stable_context, result)]
+                )
+            if result["content"]:
+                yield result["content"]
+            return
+
+        result = self._new_result()
+        content = []
+        refusal = []
+        usage = None
+        stream = None
         try:
+            # Retries only cover opening the stream; a stream that fails part
+            # way through is not replayed
+            stream = self._create_completion(
+                **self._completion_params(
+                    prompt, model, system_message, stable_context, temperature
+                ),
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            for chunk in stream:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.finish_reason is not None:
+                    result["finish_reason"] = choice.finish_reason
+                if choice.delta.refusal:
+                    refusal.append(choice.delta.refusal)
+                if choice.delta.content:
+                    content.append(choice.delta.content)
+                    yield choice.delta.content
+            result["status"] = "success"
+        except GeneratorExit:
+            result["error"] = "Stream closed before the response was complete."
+            raise
+        except Exception as e:
+            result["error"] = str(e)
+            raise
+        finally:
+            # Release the HTTP response back to the client's connection pool,
+            # including when the caller stops reading early
+            if stream is not None:
+                stream.close()
+            result["content"] = "".join(content) if content else None
+            result["refusal"] = "".join(refusal) if refusal else None
+            if result["status"] == "success" or content:
+                result["response_json_text"] = self._compact_response_json(
+                    result, usage
+                )
+            self._apply_usage(result, usage)
+            self._update_cache(cache_key, embedding, model, system_message, result)
             if store:
-                # Insert prompt into prompts table
-                self.cursor.execute(
-                    """
-                    INSERT INTO prompts (prompt, system_message, model) VALUES (?, ?, ?)
-                """,
-                    (prompt, system_message, model),
+                self._enqueue_results(
+                    [(prompt, system_message, model, stable_context, result)]
                 )
-                self.connection.commit()
-                prompt_id = self.cursor.lastrowid
 
-            # Call OpenAI API
-            client = openai.OpenAI(api_key=OPENAI_API_KEY)
+    async def agenerate_response(
+        self,
+        prompt,
+        model="gpt-4o",
+        system_message="You are a helpful assistant.",
+        store=True,
+        stable_context=None,
+        temperature=None,
+        use_cache=True,
+    ):
+        # Cache reads and writes can wait on the write lock or compute an
+        # embedding, so they run in a worker thread instead of on the loop
+        cache_key, embedding, result = await asyncio.to_thread(
+            self._lookup_cache,
+            prompt,
+            model,
+            system_message,
+            stable_context,
+            temperature,
+            use_cache,
+        )
+
+        if result is None:
+            result = await self._arequest_completion(
+                prompt,
+                model,
+                system_message,
+                stable_context=stable_context,
+                temperature=temperature,
+            )
+            await asyncio.to_thread(
+                self._update_cache, cache_key, embedding, model, system_message, result
+            )
 
-            attempt = 0
+        if store:
+            self._enqueue_results(
+                [(prompt, system_message, model, stable_context, result)]
+            )
 
-            while attempt < self.retries:
-                try:
-                    response = client.chat.completions.create(
-                        model=model,
-                        messages=[
-                            {"role": "system", "content": system_message},
-                            {"role": "user", "content": prompt},
-                        ],
+        return self._public_result(result)
+
+    async def agenerate_batch(
+        self,
+        prompts,
+        model="gpt-4o",
+        system_message="You are a helpful assistant.",
+        store=True,
+        max_concurrency=None,
+        stable_context=None,
+        temperature=None,
+        use_cache=True,
+    ):
+        semaphore = asyncio.Semaphore(max_concurrency or self.max_concurrency)
+
+        async def one(prompt):
+            cache_key, embedding, result = await asyncio.to_thread(
+                self._lookup_cache,
+                prompt,
+                model,
+                system_message,
+                stable_context,
+                temperature,
+                use_cache,
+            )
+            if result is None:
+                async with semaphore:
+                    result = await self._arequest_completion(
+                        prompt,
+                        model,
+                        system_message,
+                        stable_context=stable_context,
+                        temperature=temperature,
                     )
-                    response_json_text = response.model_dump_json()
-                    content = response.choices[0].message.content
-                    refusal = response.choices[0].message.refusal
-                    finish_reason = response.choices[0].finish_reason
-                    break
-                except Exception as e:
-                    attempt += 1
-                    if attempt >= self.retries:
-                        # If maximum attempts reached, re-raise the exception or handle it
-                        raise RuntimeError(
-                            f"Failed to generate response summary after {self.retries} attempts."
-                        ) from e
-                    else:
-                        # Optional: Log the error or provide feedback
-                        logger.warning(f"Attempt {attempt} failed: {e}. Retrying...")
-                        time.sleep(self.retry_delay_seconds)
-
-            status = "success"
-        except Exception as e:
-            error_message = str(e)
-            status = "failure"
+                await asyncio.to_thread(
+                    self._update_cache,
+                    cache_key,
+                    embedding,
+                    model,
+                    system_message,
+                    result,
+                )
+            if store:
+                # The background writer batches these with any other results
+                # that finish around the same time
+                self._enqueue_results(
+                    [(prompt, system_message, model, stable_context, result)]
+                )
+            return self._public_result(result)
+
+        return await asyncio.gather(*(one(prompt) for prompt in prompts))
+
+    def _new_result(self):
+        return {
+            "content": None,
+            "status": "failure",
+            "finish_reason": None,
+            "refusal": None,
+            "error": None,
+            "response_json_text": None,
+            "prompt_tokens": None,
+            "response_tokens": None,
+            "cached_tokens": None,
+        }
+
+    def _apply_response(self, result, response):
+        result["content"] = response.choices[0].message.content
+        result["refusal"] = response.choices[0].message.refusal
+        result["finish_reason"] = response.choices[0].finish_reason
+        if self.store_full_response:
+            result["response_json_text"] = response.model_dump_json()
+        else:
+            result["response_json_text"] = self._compact_response_json(
+                result, response.usage
+            )
+        self._apply_usage(result, response.usage)
+        result["status"] = "success"
+
+    def _apply_usage(self, result, usage):
+        if usage is not None:
+            result["prompt_tokens"] = usage.prompt_tokens
+            result["response_tokens"] = usage.completion_tokens
+            details = getattr(usage, "prompt_tokens_details", None)
+            if details is not None:
+                result["cached_tokens"] = details.cached_tokens
+
+    def _compact_response_json(self, result, usage):
+        return _json_dumps(
+            {
+                "content": result["content"],
+                "finish_reason": result["finish_reason"],
+                "refusal": result["refusal"],
+                "usage": usage.model_dump() if usage is not None else None,
+            }
+        )
+
+    def _lookup_cache(
+        self, prompt, model, system_message, stable_context, temperature, use_cache
+    ):
+        # Returns (cache_key, embedding, result). Only deterministic requests
+        # are served from the cache; result is None on a miss.
+        if not use_cache or temperature != 0:
+            return None, None, None
+
+        cache_key = self._cache_key(prompt, model, system_message, stable_context)
+        result = self._cached_result(cache_key)
+        embedding = None
+        # The semantic index is keyed on the system message only, so it
+        # cannot tell apart requests that differ in their stable context
+        if result is None and self.semantic_cache and stable_context is None:
+            embedding = self._embed(prompt)
+            result = self._semantic_cached_result(embedding, model, system_message)
+        return cache_key, embedding, result
+
+    def _update_cache(self, cache_key, embedding, model, system_message, result):
+        if cache_key is None or result["status"] != "success":
+            return
+
+        self._cache_result(cache_key, result)
+        if embedding is not None:
+            self._semantic_cache_result(embedding, model, system_message, result)
+
+    def _cache_key(self, prompt, model, system_message, stable_context=None):
+        key = f"{model}\0{system_message}\0{prompt}"
+        if stable_context is not None:
+            key += f"\0{stable_context}"
+        return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+    def _build_messages(self, prompt, system_message, stable_context=None):
+        # OpenAI caches the longest byte-identical message prefix once it is
+        # at least ~1024 tokens long. Large context that is shared between
+        # calls goes in stable_context, which is sent before the varying prompt.
+        messages = [{"role": "system", "content": system_message}]
+        if stable_context is not None:
+            messages.append({"role": "user", "content": stable_context})
+        messages.append({"role": "user", "content": prompt})
+        return messages
+
+    def _cached_result(self, cache_key):
+        with self._read_connection() as connection:
+            row = connection.execute(
+                "SELECT content, response_json FROM prompt_cache WHERE hash = ?",
+                (cache_key,),
+            ).fetchone()
+        if row is None:
+            return None
+
+        return self._result_from_cache(*row)
 
-        if store and prompt_id is not None:
-            timestamp = datetime.datetime.now()
+    def _result_from_cache(self, content, response_json_text):
+        payload = _json_loads(response_json_text)
+        result = self._new_result()
+        result["content"] = content
+        result["response_json_text"] = response_json_text
+        if "choices" in payload:
+            # Full API response, see store_full_response
+            choice = payload["choices"][0]
+            result["refusal"] = choice["message"]["refusal"]
+            result["finish_reason"] = choice["finish_reason"]
+        else:
+            result["refusal"] = payload["refusal"]
+            result["finish_reason"] = payload["finish_reason"]
+        result["status"] = "success"
+        return result
+
+    def _cache_result(self, cache_key, result):
+        with self._write_lock:
             self.cursor.execute(
                 """
-                INSERT INTO responses (
-                    prompt_id, response, error, status, refusal, finish_reason,
-                    timestamp, prompt_tokens, response_tokens
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                INSERT OR IGNORE INTO prompt_cache (hash, content, response_json)
+                VALUES (?, ?, ?)
             """,
-                (
-                    prompt_id,
-                    response_json_text,
-                    error_message,
-                    status,
-                    refusal,
-                    finish_reason,
-                    timestamp,
-                    prompt_tokens,
-                    response_tokens,
-                ),
+                (cache_key, result["content"], result["response_json_text"]),
+            )
+
+    def _embed(self, prompt):
+        if self.embedder is None:
+            from sentence_transformers import SentenceTransformer
+
+            self.embedder = SentenceTransformer(LLM_SEMANTIC_CACHE_MODEL)
+        return self.embedder.encode(
+            [prompt], normalize_embeddings=True, convert_to_numpy=True
+        ).astype("float32")
+
+    def _semantic_index(self, model, system_message, dimension):
+        # One inner-product index per (model, system_message), rebuilt from the
+        # semantic_cache table the first time it is needed. Callers hold
+        # _semantic_lock.
+        key = (model, system_message)
+        if key not in self.semantic_indexes:
+            import faiss
+            import numpy as np
+
+            index = faiss.IndexIDMap(faiss.IndexFlatIP(dimension))
+            with self._read_connection() as connection:
+                rows = connection.execute(
+                    """
+                    SELECT id, embedding FROM semantic_cache
+                    WHERE model = ? AND system_message = ?
+                """,
+                    (model, system_message),
+                ).fetchall()
+            if rows:
+                ids = np.array([row[0] for row in rows], dtype="int64")
+                vectors = np.vstack(
+                    [np.frombuffer(row[1], dtype="float32") for row in rows]
+                )
+                index.add_with_ids(vectors, ids)
+            self.semantic_indexes[key] = index
+        return self.semantic_indexes[key]
+
+    def _semantic_cached_result(self, embedding, model, system_message):
+        with self._semantic_lock:
+            index = self._semantic_index(model, system_message, embedding.shape[1])
+            if index.ntotal == 0:
+                return None
+
+            # Embeddings are normalized, so the inner product is the cosine
+            # similarity
+            scores, ids = index.search(embedding, 1)
+        if scores[0][0] < self.semantic_cache_threshold:
+            return None
+
+        with self._read_connection() as connection:
+            row = connection.execute(
+                "SELECT content, response_json FROM semantic_cache WHERE id = ?",
+                (int(ids[0][0]),),
+            ).fetchone()
+        if row is None:
+            return None
+        return self._result_from_cache(*row)
+
+    def _semantic_cache_result(self, embedding, model, system_message, result):
+        import numpy as np
+
+        with self._semantic_lock:
+            index = self._semantic_index(model, system_message, embedding.shape[1])
+            with self._write_lock:
+                self.cursor.execute(
+                    """
+                    INSERT INTO semantic_cache (
+                        model, system_message, embedding, content, response_json
+                    ) VALUES (?, ?, ?, ?, ?)
+                """,
+                    (
+                        model,
+                        system_message,
+                        embedding[0].tobytes(),
+                        result["content"],
+                        result["response_json_text"],
+                    ),
+                )
+                semantic_id = self.cursor.lastrowid
+            index.add_with_ids(embedding, np.array([semantic_id], dtype="int64"))
+
+    def _retry_delay(self, attempt, error):
+        # Honor the server's retry-after hint on rate limits
+        if isinstance(error, openai.RateLimitError):
+            response = getattr(error, "response", None)
+            retry_after = (
+                response.headers.get("retry-after") if response is not None else None
+            )
+            if retry_after is not None:
+                try:
+                    return max(0.0, float(retry_after))
+                except ValueError:
+                    pass
+
+        # Otherwise use exponential backoff with full jitter
+        return random.uniform(
+            0,
+            min(
+                self.retry_max_delay_seconds,
+                self.retry_delay_seconds * 2 ** (attempt - 1),
+            ),
+        )
+
+    def _completion_params(
+        self, prompt, model, system_message, stable_context=None, temperature=None
+    ):
+        params = {
+            "model": model,
+            "messages": self._build_messages(prompt, system_message, stable_context),
+        }
+        if temperature is not None:
+            params["temperature"] = temperature
+        return params
+
+    def _next_retry_delay(self, attempt, error):
+        # Raises when the failed call should not be retried
+        if isinstance(error, (openai.BadRequestError, openai.AuthenticationError)):
+            # Retrying will not make an invalid request succeed
+            raise error
+        if attempt >= self.retries:
+            raise RuntimeError(
+                f"Failed to generate response summary after {self.retries} attempts."
+            ) from error
+        logger.warning(f"Attempt {attempt} failed: {error}. Retrying...")
+        return self._retry_delay(attempt, error)
+
+    def _create_completion(self, **params):
+        # Call OpenAI API
+        attempt = 0
+
+        while True:
+            try:
+                return self.client.chat.completions.create(**params)
+            except Exception as e:
+                attempt += 1
+                time.sleep(self._next_retry_delay(attempt, e))
+
+    async def _acreate_completion(self, **params):
+        attempt = 0
+
+        while True:
+            try:
+                return await self.async_client.chat.completions.create(**params)
+            except Exception as e:
+                attempt += 1
+                await asyncio.sleep(self._next_retry_delay(attempt, e))
+
+    def _record_error(self, result, error):
+        result["error"] = str(error)
+        result["status"] = "failure"
+
+    def _request_completion(
+        self, prompt, model, system_message, stable_context=None, temperature=None
+    ):
+        result = self._new_result()
+        try:
+            response = self._create_completion(
+                **self._completion_params(
+                    prompt, model, system_message, stable_context, temperature
+                )
+            )
+            self._apply_response(result, response)
+        except Exception as e:
+            self._record_error(result, e)
+
+        return result
+
+    async def _arequest_completion(
+        self, prompt, model, system_message, stable_context=None, temperature=None
+    ):
+        result = self._new_result()
+        try:
+            response = await self._acreate_completion(
+                **self._completion_params(
+                    prompt, model, system_message, stable_context, temperature
+                )
             )
-            self.connection.commit()
+            self._apply_response(result, response)
+        except Exception as e:
+            self._record_error(result, e)
+
+        return result
+
+    def _enqueue_results(self, rows):
+        self._result_writer.put(rows)
 
+    def flush(self):
+        self._result_writer.flush()
+
+    def _public_result(self, result):
         return {
-            "content": content,
-            "status": status,
-            "finish_reason": finish_reason,
-            "refusal": refusal,
+            "content": result["content"],
+            "status": result["status"],
+            "finish_reason": result["finish_reason"],
+            "refusal": result["refusal"],
         }
 
     def close(self):
-        self.connection.close()
+        self._finalizer()
+        self._result_writer.raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    async def aclose(self):
+        try:
+            await self.async_client.close()
+        finally:
+            # Joining the writer thread blocks, so keep it off the event loop
+            await asyncio.to_thread(self.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
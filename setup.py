@@ -5,4 +5,9 @@ setup(
     version="0.1.0",
     packages=find_packages(),
     install_requires=[],
+    extras_require={
+        "semantic": ["sentence-transformers", "faiss-cpu", "numpy"],
+        "sqlite": ["pysqlite3-binary"],
+        "json": ["orjson"],
+    },
 )